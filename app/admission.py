@@ -0,0 +1,107 @@
+import collections
+import functools
+import math
+import threading
+
+from flask import jsonify
+
+
+class RouteLimiter:
+    """Limit of concurrent requests for one route, with a FIFO wait queue"""
+
+    def __init__(self, max_in_flight, max_queue, timeout):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.timeout = timeout
+        # guards the counters and the queue below
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+        # one event per waiting request, set when it's handed a slot
+        self._waiters = collections.deque()
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    def acquire(self):
+        """Take a slot, waiting in the queue for at most timeout seconds"""
+        with self._lock:
+            # only skip the queue if nobody is waiting in it
+            if not self._waiters and self.in_flight < self.max_in_flight:
+                self.in_flight += 1
+                return True
+
+            if len(self._waiters) >= self.max_queue:
+                self.rejected += 1
+                return False
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+
+        waiter.wait(self.timeout)
+
+        with self._lock:
+            # release() may have handed over the slot just after the timeout
+            if waiter.is_set():
+                return True
+            self._waiters.remove(waiter)
+            self.rejected += 1
+            return False
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                # hand the slot straight to the oldest waiter,
+                # so new requests can't take it first
+                self._waiters.popleft().set()
+            else:
+                self.in_flight -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "rejected": self.rejected,
+                "max_in_flight": self.max_in_flight,
+                "max_queue": self.max_queue,
+            }
+
+
+class AdmissionController:
+    """Keeps per-route limiters, so expensive routes can't hog the DB pool"""
+
+    def __init__(self):
+        self.limiters = {}
+
+    def limit(self, max_in_flight, max_queue=0, timeout=1.0):
+        """Decorator limiting concurrent calls of a view function
+
+        Requests over the limit wait in a queue of max_queue requests for
+        up to timeout seconds, after that they get a 503 with Retry-After.
+        Must be applied below @app.route.
+        """
+
+        def decorator(view):
+            limiter = RouteLimiter(max_in_flight, max_queue, timeout)
+            self.limiters[view.__name__] = limiter
+            retry_after = str(max(1, math.ceil(timeout)))
+
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                if not limiter.acquire():
+                    response = jsonify({"msg": "Server busy, try again later"})
+                    return response, 503, {"Retry-After": retry_after}
+
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    limiter.release()
+
+            return wrapper
+
+        return decorator
+
+    def stats(self):
+        """Current in-flight and queue depths per route"""
+        return {name: limiter.stats() for name, limiter in self.limiters.items()}
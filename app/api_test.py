@@ -1,7 +1,16 @@
+import gzip
+import threading
+import time
+
 import pytest
+from flask import Flask
+from werkzeug.test import Client, EnvironBuilder
 from hypothesis import given, settings, example
 from hypothesis import strategies as st
-import requests
+
+from app import app
+from compression import CompressionMiddleware
+from admission import AdmissionController, RouteLimiter
 
 
 @st.composite
@@ -154,92 +163,96 @@ def generate_random_data(draw):
     }
 )
 @given(generate_random_data())
-def test_random_candidate_full_run(data):
-    """Add all items, get items from db, make sure they're in there, then delete again"""
-
-    # clean DB from potential existing rows
-    product_deletion_url = "http://localhost:5000/products/"
-    for product in data["products"]:
-        response = requests.delete(product_deletion_url + product["name"])
-
-    # delete orders
-    order_deletion_url = "http://localhost:5000/orders/"
-    for order in data["orders"]:
-        response = requests.delete(order_deletion_url + str(order["id"]))
-
-    # add products
-    product_insertion_url = "http://localhost:5000/products"
-    for product in data["products"]:
-        response = requests.post(product_insertion_url, json=product)
-        assert (
-            "inserted into the DB" in response.json()["msg"]
-            or "already in DB" in response.json()["msg"]
-        ), response.json()["msg"]
-
-    # add orders
-    order_insertion_url = "http://localhost:5000/orders"
-    for order in data["orders"]:
-        response = requests.post(order_insertion_url, json=order)
-
-    # get json_products
-    # use GT to get all products
-    json_products_url = "http://localhost:5000/json_products"
-    response_all = requests.get(json_products_url)
-    product_names_in_db = [product["name"] for product in response_all.json()]
-    # check all products are in the response (i.e. they're in the DB)
-    for product in data["products"]:
-        assert product["name"] in product_names_in_db
-
-    # get 1 page worth of products
-    response_1_page = requests.post(
-        json_products_url, json={"page_num": 2, "results_per_page": 5}
-    )
-    # ensure 1 page is <= than all products
-    assert len(response_all.json()) >= len(response_1_page.json())
-
-    # get json_orders
-    json_orders_url = "http://localhost:5000/json_orders"
-    response_all = requests.get(json_orders_url)
-    order_ids_in_db = [order["id"] for order in response_all.json()]
-    # check all orders are in the response (i.e. they're in the DB)
-    for order in data["orders"]:
-        assert order["id"] in order_ids_in_db
-
-    # get 1 page worth of orders
-    response_1_page = requests.post(
-        json_orders_url, json={"page_num": 2, "results_per_page": 5}
-    )
-    # ensure 1 page is <= than all orders
-    assert len(response_all.json()) >= len(response_1_page.json())
-
-    # get_related_products
-    related_products_url = "http://localhost:5000/related_products"
-    a_product = data["products"][0]
-    response = requests.post(related_products_url, json={"product": a_product["name"]})
-    # expecting a list of products (potentially empty)
-    assert isinstance(response.json(), list)
-
-    # delete products
-    # clean DB from potential existing rows
-    product_deletion_url = "http://localhost:5000/products/"
-    for product in data["products"]:
-        response = requests.delete(product_deletion_url + product["name"])
-        product_name = product["name"]
-        assert (
-            response.json()["msg"]
-            == f"Product with name {product_name} has been deleted"
+def test_random_candidate_full_run(client, db_transaction, seed_db, data):
+    """Seed items, get items from db, make sure they're in there, then delete again"""
+
+    with db_transaction():
+        seed_db(data["products"], data["orders"])
+
+        # get json_products
+        # use GET to get all products
+        response_all = client.get("/json_products")
+        product_names_in_db = [product["name"] for product in response_all.json]
+        # check all products are in the response (i.e. they're in the DB)
+        for product in data["products"]:
+            assert product["name"] in product_names_in_db
+
+        # get 1 page worth of products
+        response_1_page = client.post(
+            "/json_products", json={"page_num": 2, "results_per_page": 5}
         )
+        # ensure 1 page is <= than all products
+        assert len(response_all.json) >= len(response_1_page.json)
+
+        # get json_orders
+        response_all = client.get("/json_orders")
+        order_ids_in_db = [order["id"] for order in response_all.json]
+        # check all orders are in the response (i.e. they're in the DB)
+        for order in data["orders"]:
+            assert order["id"] in order_ids_in_db
+
+        # get 1 page worth of orders
+        response_1_page = client.post(
+            "/json_orders", json={"page_num": 2, "results_per_page": 5}
+        )
+        # ensure 1 page is <= than all orders
+        assert len(response_all.json) >= len(response_1_page.json)
+
+        # get_related_products
+        a_product = data["products"][0]
+        response = client.post("/related_products", json={"product": a_product["name"]})
+        # expecting a list of products (potentially empty)
+        assert isinstance(response.json, list)
+
+        # delete products
+        for product in data["products"]:
+            response = client.delete("/products/" + product["name"])
+            product_name = product["name"]
+            assert (
+                response.json["msg"]
+                == f"Product with name {product_name} has been deleted"
+            )
+
+        # delete orders
+        for order in data["orders"]:
+            response = client.delete("/orders/" + str(order["id"]))
+            order_id = order["id"]
+            assert response.json["msg"] == f"Order with id {order_id} has been deleted"
+
+
+def test_insert_product_and_order(client, db_transaction):
+    """Insert a product and an order through the API"""
+
+    product = {"name": "myprod1", "stock": 3, "price": 1.0}
+    order = {
+        "id": 100000000,
+        "order_total": 2.0,
+        "rows": [
+            {
+                "order_id": 100000000,
+                "row_id": 100000000,
+                "product_ordered": "myprod1",
+                "quantity_ordered": 2,
+                "order_subtotal": 2.0,
+            }
+        ],
+    }
+
+    with db_transaction():
+        response = client.post("/products", json=product)
+        assert "inserted into the DB" in response.json["msg"], response.json["msg"]
+        response = client.post("/products", json=product)
+        assert "already in DB" in response.json["msg"], response.json["msg"]
 
-    # delete orders
-    order_deletion_url = "http://localhost:5000/orders/"
-    for order in data["orders"]:
-        response = requests.delete(order_deletion_url + str(order["id"]))
-        order_id = order["id"]
-        assert response.json()["msg"] == f"Order with id {order_id} has been deleted"
+        response = client.post("/orders", json=order)
+        assert response.json["msg"] == "New order inserted into the DB"
 
+        response = client.get("/json_orders")
+        assert [row["row_id"] for row in response.json] == [100000000]
 
-def test_relevant_products():
-    """Add some items, make sure they come up in related products, then delete"""
+
+def test_relevant_products(client, db_transaction, seed_db):
+    """Add some items, make sure they come up in related products"""
 
     data = {
         "products": [
@@ -260,7 +273,7 @@ def test_relevant_products():
                     },
                     {
                         "order_id": 100000000,
-                        "row_id": 100000000,
+                        "row_id": 100000001,
                         "product_ordered": "myprod2",
                         "quantity_ordered": 2,
                         "order_subtotal": 2.0,
@@ -270,34 +283,324 @@ def test_relevant_products():
         ],
     }
 
-    # add products
-    product_insertion_url = "http://localhost:5000/products"
-    for product in data["products"]:
-        response = requests.post(product_insertion_url, json=product)
-        print(response.json())
-
-    # add orders
-    order_insertion_url = "http://localhost:5000/orders"
-    for order in data["orders"]:
-        response = requests.post(order_insertion_url, json=order)
-        print(response.json())
-
-    # get_related_products
-    related_products_url = "http://localhost:5000/related_products"
-    a_product = data["products"][0]
-    response = requests.post(related_products_url, json={"product": a_product["name"]})
-    # expecting a list of products (potentially empty)
-    assert data["products"][1] in response.json()
-
-    # delete products
-    # clean DB from potential existing rows
-    product_deletion_url = "http://localhost:5000/products/"
-    for product in data["products"]:
-        response = requests.delete(product_deletion_url + product["name"])
-
-    """
-    # delete orders
-    order_deletion_url = "http://localhost:5000/orders/"
-    for order in data["orders"]:
-        response = requests.delete(order_deletion_url + str(order["id"]))
-    """
+    with db_transaction():
+        seed_db(data["products"], data["orders"])
+
+        # get_related_products
+        a_product = data["products"][0]
+        response = client.post("/related_products", json={"product": a_product["name"]})
+        assert data["products"][1]["name"] in response.json
+
+
+def test_compressed_order_rows(client, db_transaction):
+    """Streamed html table is gzipped when the client accepts it"""
+
+    with db_transaction():
+        response = client.get("/order_rows", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert b"<table>" in gzip.decompress(response.data)
+
+        response = client.get("/order_rows", headers={"Accept-Encoding": "identity"})
+        assert "Content-Encoding" not in response.headers
+
+
+def test_streamed_compression_is_flushed(client, db_transaction, seed_db):
+    """Large streamed responses are sent in several compressed chunks"""
+
+    products = [{"name": "myprod1", "stock": 3, "price": 1.0}]
+    orders = [
+        {
+            "id": order_id,
+            "order_total": 1.0,
+            "rows": [
+                {
+                    "order_id": order_id,
+                    "row_id": order_id,
+                    "product_ordered": "myprod1",
+                    "quantity_ordered": 1,
+                    "order_subtotal": 1.0,
+                }
+            ],
+        }
+        for order_id in range(1, 2001)
+    ]
+
+    with db_transaction():
+        seed_db(products, orders)
+
+        response = client.get(
+            "/order_rows", headers={"Accept-Encoding": "gzip"}, buffered=False
+        )
+        chunks = [chunk for chunk in response.response if chunk]
+        # not just the gzip header and then everything at the end
+        assert len(chunks) > 3
+        assert b"<td>2000</td>" in gzip.decompress(b"".join(chunks))
+
+
+def test_small_response_not_compressed(client, db_transaction):
+    """Responses below min_size are sent as is"""
+
+    with db_transaction():
+        response = client.get("/json_products", headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in response.headers
+        assert response.json == []
+
+
+def test_refused_encoding_not_used(client, db_transaction):
+    """q=0 means the client doesn't accept the encoding"""
+
+    with db_transaction():
+        response = client.get("/order_rows", headers={"Accept-Encoding": "gzip;q=0"})
+        assert "Content-Encoding" not in response.headers
+        assert b"<table>" in response.data
+
+
+def test_error_response_not_compressed():
+    """Only 200 responses are compressed, whatever their size"""
+
+    # the app without the middleware, wrapped again with no size threshold
+    wsgi_app = CompressionMiddleware(app.wsgi_app.wsgi_app, min_size=0)
+    response = Client(wsgi_app).get(
+        "/no_such_page", headers={"Accept-Encoding": "gzip"}
+    )
+    assert response.status_code == 404
+    assert "Content-Encoding" not in response.headers
+
+
+def test_compressed_response_closed_without_iterating():
+    """Closing the compressed body closes the wrapped one, even if never iterated"""
+
+    closed = []
+
+    class Body:
+        def __iter__(self):
+            yield b"<table></table>"
+
+        def close(self):
+            closed.append(True)
+
+    def wsgi_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/html")])
+        return Body()
+
+    environ = EnvironBuilder(headers={"Accept-Encoding": "gzip"}).get_environ()
+    result = CompressionMiddleware(wsgi_app)(environ, lambda *args: None)
+    result.close()
+    assert closed == [True]
+
+
+def test_admission_stats(client):
+    """Limited routes report their in-flight and queued requests"""
+
+    response = client.get("/admission_stats")
+    stats = response.json
+    for route in [
+        "get_json_orders",
+        "get_related_products",
+        "get_basket_recommendations",
+    ]:
+        assert stats[route]["in_flight"] == 0
+        assert stats[route]["queued"] == 0
+
+
+def test_basket_recommendations(client, db_transaction, seed_db):
+    """Products bought with the basket come up best first, basket items excluded"""
+
+    baskets = {
+        1: ["prod_a", "prod_c"],
+        2: ["prod_b", "prod_c", "prod_d"],
+        3: ["prod_a", "prod_b", "prod_e"],
+        4: ["prod_a", "prod_d"],
+        5: ["prod_a", "prod_c"],
+        # several basket products in one order still count as one order
+        6: ["prod_a", "prod_b", "prod_f"],
+        7: ["prod_a", "prod_b", "prod_f"],
+        # and so do duplicate rows of a basket product
+        8: ["prod_a", "prod_a", "prod_g"],
+    }
+    names = ["prod_a", "prod_b", "prod_c", "prod_d", "prod_e", "prod_f", "prod_g"]
+    products = [{"name": name, "stock": 3, "price": 1.0} for name in names]
+    orders = [
+        {
+            "id": order_id,
+            "order_total": float(len(names)),
+            "rows": [
+                {
+                    "order_id": order_id,
+                    "row_id": order_id * 10 + idx,
+                    "product_ordered": name,
+                    "quantity_ordered": 1,
+                    "order_subtotal": 1.0,
+                }
+                for idx, name in enumerate(names)
+            ],
+        }
+        for order_id, names in baskets.items()
+    ]
+
+    with db_transaction():
+        seed_db(products, orders)
+
+        basket_url = "/basket_recommendations"
+        response = client.post(basket_url, json={"products": ["prod_a", "prod_b"]})
+        # prod_c shares 3 orders with the basket, prod_d and prod_f 2,
+        # prod_e and prod_g 1, ties are sorted by name
+        assert response.json == ["prod_c", "prod_d", "prod_f", "prod_e", "prod_g"]
+
+        response = client.post(
+            basket_url, json={"products": ["prod_a", "prod_b"], "k": 2}
+        )
+        assert response.json == ["prod_c", "prod_d"]
+
+        response = client.post(basket_url, json={"products": ["unknown"]})
+        assert response.json == []
+
+
+def test_basket_recommendations_input(client, db_transaction, seed_db):
+    """Bad baskets and k values are rejected, k is capped"""
+
+    products = [{"name": f"prod{idx}", "stock": 3, "price": 1.0} for idx in range(150)]
+    # prod0 bought together with all the others
+    orders = [
+        {
+            "id": 1,
+            "order_total": 150.0,
+            "rows": [
+                {
+                    "order_id": 1,
+                    "row_id": idx,
+                    "product_ordered": product["name"],
+                    "quantity_ordered": 1,
+                    "order_subtotal": 1.0,
+                }
+                for idx, product in enumerate(products)
+            ],
+        }
+    ]
+
+    with db_transaction():
+        seed_db(products, orders)
+
+        basket_url = "/basket_recommendations"
+        for products_given in [None, "prod0", [], [1, 2], ["prod0", None]]:
+            response = client.post(basket_url, json={"products": products_given})
+            assert response.json == {"msg": "No products given"}, products_given
+
+        response = client.post(basket_url, json={})
+        assert response.json == {"msg": "No products given"}
+
+        for k in ["x", "5", 0, -1, 1.5, True]:
+            response = client.post(basket_url, json={"products": ["prod0"], "k": k})
+            assert response.json == {"msg": "k must be a positive integer"}, k
+
+        response = client.post(basket_url, json={"products": ["prod0"], "k": 1000})
+        assert len(response.json) == 100
+        assert "prod0" not in response.json
+
+
+def _wait_for_queue(limiter, queued):
+    "Waits until the limiter has the given number of queued requests"
+    for _ in range(200):
+        if limiter.stats()["queued"] == queued:
+            return
+        time.sleep(0.01)
+    raise AssertionError(f"queue never reached {queued}")
+
+
+def test_route_limiter_full_queue():
+    """Requests over the queue size are rejected, queued ones get the freed slot"""
+
+    limiter = RouteLimiter(max_in_flight=1, max_queue=1, timeout=5.0)
+    assert limiter.acquire()
+
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(limiter.acquire()))
+    waiter.start()
+    _wait_for_queue(limiter, 1)
+
+    # queue is full, rejected without waiting
+    assert not limiter.acquire()
+    assert limiter.stats()["rejected"] == 1
+
+    limiter.release()
+    waiter.join(timeout=5)
+    assert results == [True]
+    assert limiter.stats()["in_flight"] == 1
+    assert limiter.stats()["queued"] == 0
+
+    limiter.release()
+    assert limiter.stats()["in_flight"] == 0
+
+
+def test_route_limiter_queue_timeout():
+    """Queued requests give up after the timeout"""
+
+    limiter = RouteLimiter(max_in_flight=1, max_queue=1, timeout=0.05)
+    assert limiter.acquire()
+    assert not limiter.acquire()
+
+    stats = limiter.stats()
+    assert stats["rejected"] == 1
+    assert stats["queued"] == 0
+    assert stats["in_flight"] == 1
+
+
+def test_route_limiter_no_queue_jumping():
+    """A freed slot goes to the queued request, not to a new one"""
+
+    limiter = RouteLimiter(max_in_flight=1, max_queue=2, timeout=5.0)
+    assert limiter.acquire()
+
+    admitted = []
+
+    def _queued_request():
+        if limiter.acquire():
+            admitted.append("queued")
+            limiter.release()
+
+    waiter = threading.Thread(target=_queued_request)
+    waiter.start()
+    _wait_for_queue(limiter, 1)
+
+    limiter.release()
+    # a new request has to wait behind the queued one
+    if limiter.acquire():
+        admitted.append("new")
+        limiter.release()
+    waiter.join(timeout=5)
+
+    assert admitted == ["queued", "new"]
+
+
+def test_admission_overloaded_route():
+    """Overloaded routes answer 503 with Retry-After, errors free their slot"""
+
+    test_app = Flask("admission_test")
+    admission = AdmissionController()
+
+    @test_app.route("/busy")
+    @admission.limit(max_in_flight=1, max_queue=0, timeout=1.5)
+    def busy():
+        return {"msg": "ok"}
+
+    @test_app.route("/broken")
+    @admission.limit(max_in_flight=1)
+    def broken():
+        raise ValueError("broken view")
+
+    client = test_app.test_client()
+
+    limiter = admission.limiters["busy"]
+    assert limiter.acquire()
+    response = client.get("/busy")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "2"
+    assert admission.stats()["busy"]["rejected"] == 1
+
+    limiter.release()
+    assert client.get("/busy").status_code == 200
+
+    assert client.get("/broken").status_code == 500
+    assert admission.stats()["broken"]["in_flight"] == 0
+    assert client.get("/broken").status_code == 500
+    assert admission.stats()["broken"]["rejected"] == 0
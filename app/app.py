@@ -1,11 +1,15 @@
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, request, render_template, stream_template, jsonify
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship
+from sqlalchemy import func, select
+from sqlalchemy.orm import relationship, aliased
 import os
+import heapq
 from datetime import datetime
 from collections import defaultdict
 
 from util import *
+from compression import CompressionMiddleware
+from admission import AdmissionController
 
 app = Flask(__name__)
 
@@ -16,9 +20,23 @@ port = os.getenv("PORT")
 host = os.getenv("HOST")
 
 postgres_url = f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
-app.config["SQLALCHEMY_DATABASE_URI"] = postgres_url
+# DATABASE_URL overrides the postgres DB, e.g. with sqlite for tests
+app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL", postgres_url)
 db = SQLAlchemy(app)
 
+# compress large JSON and HTML responses for clients that accept it
+app.wsgi_app = CompressionMiddleware(
+    app.wsgi_app,
+    level=int(os.getenv("COMPRESS_LEVEL", 6)),
+    brotli_level=int(os.getenv("COMPRESS_BROTLI_LEVEL", 4)),
+    min_size=int(os.getenv("COMPRESS_MIN_SIZE", 500)),
+    flush_size=int(os.getenv("COMPRESS_FLUSH_SIZE", 16384)),
+)
+
+# limit concurrent expensive requests, so they don't use up the DB pool
+# (5 connections + 10 overflow by default) and starve cheap inserts
+admission = AdmissionController()
+
 
 class Product(db.Model):
     __tablename__ = "products"
@@ -223,7 +241,9 @@ def orders():
             return jsonify({"msg": f"Inserting new order failed"})
 
 
+# limited for POSTs too, a bad pagination body falls back to the full query
 @app.route("/json_orders", methods=["GET", "POST"])
+@admission.limit(max_in_flight=2, max_queue=4, timeout=2.0)
 def get_json_orders():
     if request.method == "GET":
         rows = (
@@ -273,6 +293,7 @@ def get_json_orders():
 
 
 @app.route("/related_products", methods=["POST"])
+@admission.limit(max_in_flight=4, max_queue=8, timeout=2.0)
 def get_related_products():
     """Return products that have been bought together with product p"""
 
@@ -311,11 +332,73 @@ def get_related_products():
     )
 
 
+# more than this many recommendations are never returned
+MAX_BASKET_RECOMMENDATIONS = 100
+
+
+@app.route("/basket_recommendations", methods=["POST"])
+@admission.limit(max_in_flight=4, max_queue=8, timeout=2.0)
+def get_basket_recommendations():
+    """Return the top k products bought together with the products in a basket"""
+
+    data = request.json
+    if not isinstance(data, dict):
+        return {"msg": "No products given"}
+
+    products = data.get("products")
+    if (
+        not isinstance(products, list)
+        or not products
+        or not all(isinstance(product, str) for product in products)
+    ):
+        return {"msg": "No products given"}
+    basket = set(products)
+
+    k = data.get("k", 10)
+    # bool is a subclass of int, but not a valid k
+    if not isinstance(k, int) or isinstance(k, bool) or k < 1:
+        return {"msg": "k must be a positive integer"}
+    k = min(k, MAX_BASKET_RECOMMENDATIONS)
+
+    # score each product by the number of orders it shares with any basket product,
+    # all basket products at once in one query
+    basket_row = aliased(OrderRow)
+    other_row = aliased(OrderRow)
+    scores = (
+        select(
+            other_row.product_ordered,
+            func.count(other_row.order_id.distinct()).label("score"),
+        )
+        .join(basket_row, basket_row.order_id == other_row.order_id)
+        .where(basket_row.product_ordered.in_(basket))
+        .where(other_row.product_ordered.not_in(basket))
+        .group_by(other_row.product_ordered)
+        .execution_options(yield_per=1000)
+    )
+
+    # keep only the best k in a heap, instead of sorting all candidates
+    # ties are broken by product name
+    top_k = heapq.nsmallest(
+        k,
+        db.session.execute(scores),
+        key=lambda row: (-row.score, row.product_ordered),
+    )
+
+    return jsonify([row.product_ordered for row in top_k])
+
+
 @app.route("/order_rows", methods=["GET"])
 def order_rows():
     # send list of orders
     orders = OrderRow.query.all()
-    return render_template("order_rows.html", orders=orders)
+    # stream the table, so it gets compressed as it's rendered
+    return stream_template("order_rows.html", orders=orders)
+
+
+@app.route("/admission_stats", methods=["GET"])
+def admission_stats():
+    # in-flight and queued requests per limited route
+    return jsonify(admission.stats())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,149 @@
+import zlib
+
+from werkzeug.http import parse_accept_header
+from werkzeug.wsgi import ClosingIterator
+
+# brotli is optional, only gzip is offered if it's not installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE_MIMETYPES = (
+    "application/json",
+    "text/html",
+    "text/plain",
+    "text/css",
+    "application/javascript",
+)
+
+
+class CompressionMiddleware:
+    """WSGI middleware that gzip/brotli compresses responses chunk by chunk
+
+    The encoding is picked from the client's Accept-Encoding header.
+    Responses with a known Content-Length below min_size are left as is,
+    streamed responses (no Content-Length) are always compressed.
+    The compressor is flushed after every flush_size bytes of input,
+    so streamed responses reach the client as they're rendered.
+    """
+
+    def __init__(
+        self, wsgi_app, level=6, brotli_level=4, min_size=500, flush_size=16384
+    ):
+        self.wsgi_app = wsgi_app
+        self.level = level
+        self.brotli_level = brotli_level
+        self.min_size = min_size
+        self.flush_size = flush_size
+
+    def __call__(self, environ, start_response):
+        encoding = self.choose_encoding(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        if encoding is None or environ.get("REQUEST_METHOD") == "HEAD":
+            return self.wsgi_app(environ, start_response)
+
+        # filled in once the wrapped app has sent its status and headers
+        state = {"compressor": None}
+
+        def _start_response(status, headers, exc_info=None):
+            if self.should_compress(status, headers):
+                headers = [
+                    (key, value)
+                    for key, value in headers
+                    if key.lower() != "content-length"
+                ]
+                headers.append(("Content-Encoding", encoding))
+                headers.append(("Vary", "Accept-Encoding"))
+                state["compressor"] = self.make_compressor(encoding)
+            return start_response(status, headers, exc_info)
+
+        app_iter = self.wsgi_app(environ, _start_response)
+        if state["compressor"] is None:
+            return app_iter
+
+        # closes the wrapped iterable even if the body is never iterated
+        return ClosingIterator(
+            self.compress_iter(app_iter, state["compressor"]),
+            getattr(app_iter, "close", None),
+        )
+
+    def choose_encoding(self, accept_encoding):
+        """Return the best encoding the client accepts, or None"""
+        accepted = parse_accept_header(accept_encoding)
+        gzip_quality = accepted.quality("gzip")
+        if brotli is not None:
+            brotli_quality = accepted.quality("br")
+            if brotli_quality and brotli_quality >= gzip_quality:
+                return "br"
+        if gzip_quality:
+            return "gzip"
+        return None
+
+    def should_compress(self, status, headers):
+        """Check that the response is worth compressing"""
+        if not status.startswith("200"):
+            return False
+
+        headers = {key.lower(): value for key, value in headers}
+        if "content-encoding" in headers:
+            return False
+
+        mimetype = headers.get("content-type", "").split(";")[0].strip()
+        if mimetype not in COMPRESSIBLE_MIMETYPES:
+            return False
+
+        content_length = headers.get("content-length")
+        if content_length is not None and int(content_length) < self.min_size:
+            return False
+
+        return True
+
+    def make_compressor(self, encoding):
+        if encoding == "br":
+            return BrotliCompressor(self.brotli_level)
+        return GzipCompressor(self.level)
+
+    def compress_iter(self, app_iter, compressor):
+        """Compress the body as it's produced, never holding all of it"""
+        unflushed = 0
+        for chunk in app_iter:
+            data = compressor.compress(chunk)
+            unflushed += len(chunk)
+            # the compressor buffers internally, flush it now and then
+            # so the client isn't kept waiting until the end
+            if unflushed >= self.flush_size:
+                data += compressor.flush()
+                unflushed = 0
+            if data:
+                yield data
+        yield compressor.finish()
+
+
+class GzipCompressor:
+    def __init__(self, level):
+        # wbits=31 makes zlib write the gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliCompressor:
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
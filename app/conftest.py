@@ -1,7 +1,19 @@
+import contextlib
 import json
+import os
 import pathlib
 
 import pytest
+import sqlalchemy as sa
+from sqlalchemy import orm
+from flask_sqlalchemy.query import Query
+
+# tests run against an in-memory sqlite DB unless TEST_DATABASE_URL is set,
+# e.g. to the docker-compose postgres DB.
+# Must be set before the app is imported, since it connects on import
+os.environ["DATABASE_URL"] = os.getenv("TEST_DATABASE_URL", "sqlite://")
+
+from app import app, db, Product, OrderMaster, OrderRow
 
 
 @pytest.fixture(name="test_file")
@@ -22,3 +34,74 @@ def _json_test_file(test_file):
             return json.load(json_file)
 
     return _open
+
+
+@pytest.fixture(name="client", scope="session")
+def _client():
+    "Flask test client, requests are handled in-process"
+    app.config["TESTING"] = True
+    return app.test_client()
+
+
+@pytest.fixture(name="db_transaction", scope="session")
+def _db_transaction():
+    """Gives a context manager that rolls back all DB changes made inside it
+
+    Session scoped, so it can be used once per hypothesis example.
+    The app's commits only release savepoints within the outer transaction.
+    """
+    with app.app_context():
+        engine = db.engine
+
+    if engine.dialect.name == "sqlite":
+        # pysqlite doesn't emit BEGIN itself, which breaks savepoints
+        @sa.event.listens_for(engine, "begin")
+        def _do_begin(connection):
+            connection.connection.dbapi_connection.isolation_level = None
+            connection.exec_driver_sql("BEGIN")
+
+    @contextlib.contextmanager
+    def _transaction():
+        connection = engine.connect()
+        transaction = connection.begin()
+        app_session = db.session
+        db.session = orm.scoped_session(
+            orm.sessionmaker(
+                bind=connection,
+                join_transaction_mode="create_savepoint",
+                query_cls=Query,
+            )
+        )
+        try:
+            with app.app_context():
+                yield
+        finally:
+            db.session.remove()
+            db.session = app_session
+            transaction.rollback()
+            connection.close()
+
+    return _transaction
+
+
+@pytest.fixture(name="seed_db", scope="session")
+def _seed_db():
+    "Inserts products and orders (in the POST /orders format) in bulk"
+
+    def _seed(products, orders):
+        order_masters = [
+            {"id": order["id"], "order_total": order["order_total"]} for order in orders
+        ]
+        order_rows = [row for order in orders for row in order["rows"]]
+
+        # one executemany per table, empty lists would insert a single default row
+        for model, rows in [
+            (Product, products),
+            (OrderMaster, order_masters),
+            (OrderRow, order_rows),
+        ]:
+            if rows:
+                db.session.execute(sa.insert(model), rows)
+        db.session.commit()
+
+    return _seed